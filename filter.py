@@ -1,21 +1,122 @@
 ﻿import argparse
 import re
+import mmap
 import sys
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Any, Optional
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, List, Tuple, Union
 
-def fetch_bodies(system_name: str) -> Dict[str, Any]:
-	"""Fetch bodies (stars/planets) from EDSM."""
+MAX_IN_FLIGHT = 4  # Systems fetched concurrently
+INFO_BATCH_SIZE = 25  # Systems per /api-v1/systems request
+RATE_LIMIT_BURST = 120  # Requests allowed back to back
+RATE_LIMIT_PER_SEC = 2.0  # Sustained rate → 120 requests/minute (EDSM limit)
+MAX_THROTTLE_ATTEMPTS = 3  # Attempts per request while EDSM answers HTTP 429
+DEFAULT_RETRY_AFTER = 60.0  # Seconds to back off when 429 has no Retry-After
+
+class Body(msgspec.Struct):
+	"""Body fields filter_system_names() reads, others are skipped on decode"""
+	type: Optional[str] = None
+	subType: Optional[str] = ""
+	isMainStar: Optional[bool] = False
+	isLandable: Optional[bool] = False
+	atmosphereType: Optional[str] = None
+
+class SystemPayload(msgspec.Struct):
+	"""EDSM bodies reply, enriched with info by fetch_full_system()"""
+	id: int = 0
+	name: str = ""
+	url: str = ""
+	bodyCount: Optional[int] = 0
+	bodies: List[Body] = []
+	coords: Optional[Dict[str, float]] = None
+	information: Optional[Dict[str, Any]] = None
+
+class TokenBucket:
+	"""Thread-safe token bucket: bursts up to capacity, then refill_per_sec requests per second"""
+
+	def __init__(self, capacity: int, refill_per_sec: float):
+		self.capacity = capacity
+		self.refill_per_sec = refill_per_sec
+		self.tokens = float(capacity)
+		self.last_refill = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_sec)
+		self.last_refill = now
+
+	def acquire(self, tokens: int = 1):
+		"""Take tokens, blocking only while the bucket is empty"""
+		while True:
+			with self.lock:
+				self._refill()
+				if self.tokens >= tokens:
+					self.tokens -= tokens
+					return
+				delay = (tokens - self.tokens) / self.refill_per_sec
+			time.sleep(delay)
+
+	def pause(self, seconds: float):
+		"""Drain the bucket so no tokens are available for the given time"""
+		with self.lock:
+			self._refill()
+			self.tokens = min(self.tokens, -seconds * self.refill_per_sec)
+
+bucket = TokenBucket(RATE_LIMIT_BURST, RATE_LIMIT_PER_SEC)
+
+def make_session() -> requests.Session:
+	"""Session keeping connections to EDSM alive, with retries on server errors"""
+	session = requests.Session()
+	# 429 is not retried here: edsm_get() handles it through the token bucket
+	retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+	session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry))
+	return session
+
+SESSION = make_session()
+
+def get_retry_after(response) -> float:
+	"""Read Retry-After header (seconds or HTTP date) of a throttled response"""
+	value = response.headers.get("Retry-After")
+	if not value:
+		return DEFAULT_RETRY_AFTER
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+	try:
+		return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
+
+def edsm_get(url: str, params: Union[Dict[str, Any], List[Tuple[str, Any]]]):
+	"""GET from EDSM within the rate limit, re-queueing requests throttled with 429"""
+	for _ in range(MAX_THROTTLE_ATTEMPTS):
+		bucket.acquire(1)
+		r = SESSION.get(url, params=params, timeout=15)
+		if r.status_code != 429:
+			break
+		bucket.pause(get_retry_after(r))
+	r.raise_for_status()
+	return r
+
+def fetch_bodies(system_name: str) -> Optional[SystemPayload]:
+	"""Fetch bodies (stars/planets) from EDSM, None on error."""
 	url = "https://www.edsm.net/api-system-v1/bodies"
 	params = {"systemName": system_name}
 	try:
-		r = requests.get(url, params=params, timeout=15)
-		r.raise_for_status()
-		return r.json()
-	except Exception as e:
-		return {"error": str(e), "system": system_name, "msgnum": 999}
+		r = edsm_get(url, params)
+		return msgspec.json.decode(r.content, type=SystemPayload)
+	except Exception:
+		return None
 
 def fetch_info(system_name: str) -> Optional[Dict[str, Any]]:
 	"""Fetch coords + information (allegiance, population, etc.)."""
@@ -27,45 +128,91 @@ def fetch_info(system_name: str) -> Optional[Dict[str, Any]]:
 		"showPermit": 1
 	}
 	try:
-		r = requests.get(url, params=params, timeout=15)
-		r.raise_for_status()
-		return r.json()
+		r = edsm_get(url, params)
+		return msgspec.json.decode(r.content)
 	except Exception:
 		return None
 
-def fetch_full_system(system_name: str) -> Dict[str, Any]:
-	"""Combine bodies + info into one structure."""
+def fetch_info_batch(system_names: list[str]) -> Dict[str, Any]:
+	"""Fetch coords + information for many systems, several per request."""
+	url = "https://www.edsm.net/api-v1/systems"
+	results = {}
+	for start in range(0, len(system_names), INFO_BATCH_SIZE):
+		chunk = system_names[start:start + INFO_BATCH_SIZE]
+		params = [("systemName[]", name) for name in chunk]
+		params += [("showCoordinates", 1), ("showInformation", 1), ("showPermit", 1)]
+		try:
+			data = msgspec.json.decode(edsm_get(url, params).content)
+		except Exception as e:
+			# Systems of a failed batch fall back to single requests
+			print(f"Batch info request failed: {e}", file=sys.stderr)
+			continue
+		if data and not isinstance(data, list):
+			# Error object instead of system list, fall back to single requests as well
+			print(f"Batch info request failed: unexpected reply {data!r}", file=sys.stderr)
+			continue
+		# EDSM returns known systems only, with canonical name capitalization
+		by_name = {info.get("name", "").lower(): info
+				   for info in data or [] if isinstance(info, dict)}
+		for name in chunk:
+			# Unknown systems are stored like the empty reply of /api-v1/system
+			info = by_name.get(name.lower(), [])
+			results[name] = info
+	return results
+
+def fetch_full_system(system_name: str, executor: ThreadPoolExecutor, info: Any = None) -> Optional[SystemPayload]:
+	"""Fetch bodies (+ info unless prefetched) concurrently and combine into one structure."""
+	info_future = executor.submit(fetch_info, system_name) if info is None else None
 	bodies_data = fetch_bodies(system_name)
+	if info_future is not None:
+		info = info_future.result()
 	
 	# If we got actual data (not an error), try to enrich it
-	if "bodies" in bodies_data or "id" in bodies_data:
-		info = fetch_info(system_name)
-		if info:
-			bodies_data["coords"] = info.get("coords")
-			bodies_data["information"] = info.get("information", {})
+	if info and bodies_data is not None and bodies_data.id:
+		bodies_data.coords = info.get("coords")
+		bodies_data.information = info.get("information", {})
 
 	return bodies_data	
 	# return {system_name.strip(): bodies_data}
 
+def fetch_systems(system_names: list[str]):
+	"""Fetch systems with up to MAX_IN_FLIGHT in progress, yield (name, data) in input order."""
+	infos = fetch_info_batch(system_names)
+	pending = deque()
+	with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as system_pool, \
+			ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as info_pool:
+		for sys_name in system_names:
+			pending.append((sys_name, system_pool.submit(fetch_full_system, sys_name, info_pool, infos.get(sys_name))))
+			if len(pending) >= MAX_IN_FLIGHT:
+				name, future = pending.popleft()
+				yield name, future.result()
+		while pending:
+			name, future = pending.popleft()
+			yield name, future.result()
+
 def extract_matches(input_file, pattern):
 	"""
-	Process input file and return all regex matches as a list
+	Scan whole input file in one pass and return all regex matches as a list
 	
 	Args:
-		input_file: File-like object to read from
-		pattern: Compiled regex pattern
+		input_file: Binary file-like object to read from
+		pattern: Compiled bytes regex pattern, match in group 1
 	
 	Returns:
 		List of matched strings
 	"""
-	matches = []
-	for line in input_file:
-		match = pattern.search(line)
-		if match:
-			matches.append(match.group(0))
-	return matches
-
-@dataclass
+	try:
+		data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		# Empty files, pipes and stdin can't be mapped
+		data = input_file.read()
+	try:
+		return [match.group(1).decode('utf-8', errors='replace') for match in pattern.finditer(data)]
+	finally:
+		if isinstance(data, mmap.mmap):
+			data.close()
+
+@dataclass(slots=True)
 class PlanetData:
 	name: str
 	mainStar: str
@@ -78,31 +225,31 @@ def filter_system_names(system_names: list[str]):
 	# results = []
 	total = len(system_names)
 
-	for idx, sys_name in enumerate(system_names, 1):
-		print(f"[{idx}/{total}] Fetching {sys_name}...", file=sys.stderr)
-		data = fetch_full_system(sys_name)
-		if not data:
+	for idx, (sys_name, data) in enumerate(fetch_systems(system_names), 1):
+		print(f"[{idx}/{total}] Fetched {sys_name}", file=sys.stderr)
+		if data is None:
 			print(f"no data for {sys_name}")
+			continue
 
 		# print(data)
 		# print(type(data))
 		starCount = 0
 		planetCount = 0
 		starType = ''
-		numBodies = data['bodyCount']
-		bodies = data['bodies']
+		numBodies = data.bodyCount
+		bodies = data.bodies
 		hasLandable = False
 		hasAtmosphere = False
 		for bodyIdx, body in enumerate(bodies):
-			bodyType = body['type']
+			bodyType = body.type
 			if bodyType == 'Star':
 				starCount += 1
-				if body['isMainStar']:
-					starType = body['subType']
+				if body.isMainStar:
+					starType = body.subType
 			elif bodyType == 'Planet':
-				if body['isLandable']:
+				if body.isLandable:
 					hasLandable = True
-					if body['atmosphereType'] != "No atmosphere":
+					if body.atmosphereType != "No atmosphere":
 						hasAtmosphere = True
 				planetCount += 1
 			# print(body)
@@ -120,25 +267,22 @@ def filter_system_names(system_names: list[str]):
 			# results.append((sys_name, hasLandable, hasAtmosphere))
 			yield tmp
 		# results.update(data)
-		
-		# Two requests per system → sleep 1s → ~120 requests/minute (EDSM limit)
-		if idx < total:
-			time.sleep(1)
 
 def main():
 	parser = argparse.ArgumentParser(description='Extract system names from log files')
-	parser.add_argument('input', type=argparse.FileType('r'), help='Input logfile to process')
+	parser.add_argument('input', type=argparse.FileType('rb'), help='Input logfile to process')
 	parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
 						help='Output file (default: stdout)')
 	
 	args = parser.parse_args()
 	
-	# Fixed regex pattern with decimal numbers only
-	pattern = re.compile(r'(?<=System: ).*(?= \(ID64: [0-9]+\))')
+	# Fixed regex pattern with decimal numbers only, system name in group 1.
+	# No lookbehind: the literal prefix lets the engine skip to candidate positions
+	pattern = re.compile(rb'System: (.*?) \(ID64: [0-9]+\)')
 	
 	try:
-		# Get all matches as a list
-		matches = extract_matches(args.input, pattern)
+		# Get all matches as a list, without repeats (order preserved)
+		matches = list(dict.fromkeys(extract_matches(args.input, pattern)))
 		filtered = filter_system_names(matches)
 		
 		# Output results
@@ -146,11 +290,12 @@ def main():
 		# 	args.output.write(f"{match}\n")
 		for cur in filtered:
 			print(cur)
-			args.output.write(f"{cur.name}\n")
-			args.output.write(f"Main star: {cur.mainStar}\n")
-			args.output.write(f"Stars: {cur.numStars:>2} planets: {cur.numPlanets:>2}\n")
-			args.output.write(f"Landable: {cur.hasLandable} Atmosphere: {cur.hasAtmosphere}\n")
-			args.output.write(f"{'-'*40}\n")
+			args.output.write(
+				f"{cur.name}\n"
+				f"Main star: {cur.mainStar}\n"
+				f"Stars: {cur.numStars:>2} planets: {cur.numPlanets:>2}\n"
+				f"Landable: {cur.hasLandable} Atmosphere: {cur.hasAtmosphere}\n"
+				f"{'-'*40}\n")
 			
 	finally:
 		args.input.close()
@@ -1,77 +1,331 @@
 ﻿import argparse
 import re
+import mmap
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import os
-import json
-import hashlib
-from dataclasses import dataclass
-from typing import Dict, Any, Optional, Tuple
-
-CACHE_DIR = ".edsm_data"
-
-def ensure_cache_dir():
-	"""Create cache directory if it doesn't exist"""
-	if not os.path.exists(CACHE_DIR):
-		os.makedirs(CACHE_DIR, exist_ok=True)
-
-def get_cache_filename(system_name: str, endpoint: str) -> str:
-	"""Generate cache filename using SHA-1 hash of system name"""
-	ensure_cache_dir()
-	safe_name = hashlib.sha1(system_name.encode('utf-8')).hexdigest()
-	return os.path.join(CACHE_DIR, f"{endpoint}_{safe_name}.json")
-
-def load_from_cache(cache_file: str) -> Optional[Dict]:
-	"""Load data from cache file if it exists and is valid"""
-	if not os.path.exists(cache_file):
-		return None
-	
-	try:
-		with open(cache_file, 'r') as f:
-			return json.load(f)
-	except (json.JSONDecodeError, OSError):
-		# Invalid cache file - delete it and return None
-		try:
-			os.remove(cache_file)
-		except OSError:
-			pass
-		return None
+import msgspec
+import sqlite3
+import threading
+from operator import attrgetter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, List, Tuple, Union
+
+CACHE_DB = ".edsm_cache.db"
+LEGACY_CACHE_DIR = ".edsm_data"  # Per-file cache with SHA-1 names, imported once
+CACHE_COMMIT_EVERY = 50  # Cache writes per transaction
+PREFETCH_WINDOW = 16  # Systems fetched ahead of processing, cache hits included
+MAX_HTTP_IN_FLIGHT = 4  # Concurrent requests to EDSM
+INFO_BATCH_SIZE = 25  # Systems per /api-v1/systems request
+RATE_LIMIT_BURST = 120  # Requests allowed back to back
+RATE_LIMIT_PER_SEC = 2.0  # Sustained rate → 120 requests/minute (EDSM limit)
+MAX_THROTTLE_ATTEMPTS = 3  # Attempts per request while EDSM answers HTTP 429
+DEFAULT_RETRY_AFTER = 60.0  # Seconds to back off when 429 has no Retry-After
+BAD_STAR_CLASSES = frozenset({"T (Brown dwarf) Star"})
+NO_ATMOSPHERE = "No atmosphere"
+
+# Body counter indexes, in PlanetData field order
+(NUM_STARS, NUM_PLANETS, NUM_LANDABLE, NUM_ATMOSPHERE, NUM_RINGS, NUM_BELTS,
+ NUM_ROCKY, NUM_HMC, NUM_ELWS, NUM_WWS, NUM_BLACK_HOLES, NUM_NSTARS) = range(12)
+NUM_COUNTERS = 12
+# Body subType → counter it increments
+STAR_SUBTYPE_COUNTER = {
+	"Black Hole": NUM_BLACK_HOLES,
+	"Neutron Star": NUM_NSTARS,
+}
+PLANET_SUBTYPE_COUNTER = {
+	"Water world": NUM_WWS,
+	"Earth-like world": NUM_ELWS,
+}
+# Only counted for landable planets
+LANDABLE_SUBTYPE_COUNTER = {
+	"Rocky body": NUM_ROCKY,
+	"High metal content world": NUM_HMC,
+}
+
+class Ring(msgspec.Struct):
+	"""Ring or belt, only counted - all fields are skipped on decode"""
+
+class Body(msgspec.Struct, omit_defaults=True):
+	"""Body fields filter_system_names() reads, others are skipped on decode"""
+	type: Optional[str] = None
+	subType: Optional[str] = ""
+	isMainStar: Optional[bool] = False
+	isLandable: Optional[bool] = False
+	atmosphereType: Optional[str] = None
+	rings: Optional[List[Ring]] = None
+	belts: Optional[List[Ring]] = None
+
+class SystemPayload(msgspec.Struct, omit_defaults=True):
+	"""EDSM bodies reply, enriched with info by fetch_full_system()"""
+	id: int = 0
+	name: str = ""
+	url: str = ""
+	bodyCount: Optional[int] = 0
+	bodies: List[Body] = []
+	coords: Optional[Dict[str, float]] = None
+	information: Optional[Dict[str, Any]] = None
+
+class TokenBucket:
+	"""Thread-safe token bucket: bursts up to capacity, then refill_per_sec requests per second"""
+
+	def __init__(self, capacity: int, refill_per_sec: float):
+		self.capacity = capacity
+		self.refill_per_sec = refill_per_sec
+		self.tokens = float(capacity)
+		self.last_refill = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_sec)
+		self.last_refill = now
+
+	def acquire(self, tokens: int = 1):
+		"""Take tokens, blocking only while the bucket is empty"""
+		while True:
+			with self.lock:
+				self._refill()
+				if self.tokens >= tokens:
+					self.tokens -= tokens
+					return
+				delay = (tokens - self.tokens) / self.refill_per_sec
+			time.sleep(delay)
+
+	def pause(self, seconds: float):
+		"""Drain the bucket so no tokens are available for the given time"""
+		with self.lock:
+			self._refill()
+			self.tokens = min(self.tokens, -seconds * self.refill_per_sec)
+
+bucket = TokenBucket(RATE_LIMIT_BURST, RATE_LIMIT_PER_SEC)
+http_slots = threading.BoundedSemaphore(MAX_HTTP_IN_FLIGHT)
 
-def save_to_cache(cache_file: str, data: Dict):
-	"""Save data to cache file"""
+def make_session() -> requests.Session:
+	"""Session keeping connections to EDSM alive, with retries on server errors"""
+	session = requests.Session()
+	# 429 is not retried here: edsm_get() handles it through the token bucket
+	retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+	session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry))
+	return session
+
+SESSION = make_session()
+
+def get_retry_after(response) -> float:
+	"""Read Retry-After header (seconds or HTTP date) of a throttled response"""
+	value = response.headers.get("Retry-After")
+	if not value:
+		return DEFAULT_RETRY_AFTER
 	try:
-		with open(cache_file, 'w') as f:
-			json.dump(data, f)
-	except OSError:
-		# Failed to save cache - non-critical error
+		return max(0.0, float(value))
+	except ValueError:
 		pass
+	try:
+		return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
 
-def fetch_bodies(system_name: str) -> Tuple[Dict[str, Any], bool]:
-	"""Fetch bodies (stars/planets) from EDSM with caching"""
-	cache_file = get_cache_filename(system_name, "bodies")
-	cached_data = load_from_cache(cache_file)
-	if cached_data is not None:
-		return cached_data, False
+def edsm_get(url: str, params: Union[Dict[str, Any], List[Tuple[str, Any]]],
+			 headers: Optional[Dict[str, str]] = None):
+	"""GET from EDSM within the rate limit, re-queueing requests throttled with 429"""
+	for _ in range(MAX_THROTTLE_ATTEMPTS):
+		bucket.acquire(1)
+		with http_slots:
+			r = SESSION.get(url, params=params, headers=headers, timeout=15)
+		if r.status_code != 429:
+			break
+		bucket.pause(get_retry_after(r))
+	r.raise_for_status()
+	return r
+
+class CacheDB:
+	"""EDSM response cache in a single SQLite file, shared between fetch threads"""
+
+	def __init__(self, path: str):
+		self.path = path
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.readers = threading.local()
+		self.pending_writes = 0
+		self.conn.execute("PRAGMA journal_mode = WAL")
+		self.conn.execute("PRAGMA synchronous = NORMAL")
+		self.conn.execute('''
+		CREATE TABLE IF NOT EXISTS cache (
+			endpoint TEXT NOT NULL,
+			name TEXT NOT NULL,
+			json BLOB NOT NULL,
+			fetched_at INTEGER NOT NULL,
+			etag TEXT,
+			last_modified TEXT,
+			PRIMARY KEY (endpoint, name)
+		)
+		''')
+		self.conn.commit()
+
+	def _reader(self) -> sqlite3.Connection:
+		"""
+		Per-thread read connection, so cache hits in different threads don't
+		wait for each other. Only sees committed entries, see flush().
+		"""
+		conn = getattr(self.readers, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.path)
+			self.readers.conn = conn
+		return conn
+
+	def contains(self, system_name: str, endpoint: str) -> bool:
+		"""Check if an entry is cached without decoding it"""
+		row = self._reader().execute(
+			"SELECT 1 FROM cache WHERE endpoint = ? AND name = ?",
+			(endpoint, system_name)).fetchone()
+		return row is not None
+
+	def load(self, system_name: str, endpoint: str, type: Any = Any) -> Optional[Any]:
+		"""Load cached entry decoded as type, None if missing or invalid"""
+		row = self._reader().execute(
+			"SELECT json FROM cache WHERE endpoint = ? AND name = ?",
+			(endpoint, system_name)).fetchone()
+		if row is None:
+			return None
+		try:
+			return msgspec.json.decode(row[0], type=type)
+		except msgspec.DecodeError:
+			# Invalid entry - treat as missing, next fetch overwrites it
+			return None
+
+	def validators(self, system_name: str, endpoint: str) -> Tuple[Optional[str], Optional[str]]:
+		"""ETag and Last-Modified stored with an entry, for conditional requests"""
+		row = self._reader().execute(
+			"SELECT etag, last_modified FROM cache WHERE endpoint = ? AND name = ?",
+			(endpoint, system_name)).fetchone()
+		return row if row is not None else (None, None)
+
+	def save(self, system_name: str, endpoint: str, data: Any,
+			 etag: Optional[str] = None, last_modified: Optional[str] = None):
+		"""Upsert entry, committing every CACHE_COMMIT_EVERY writes"""
+		with self.lock:
+			self.conn.execute('''
+			INSERT INTO cache (endpoint, name, json, fetched_at, etag, last_modified)
+			VALUES (?, ?, ?, ?, ?, ?)
+			ON CONFLICT (endpoint, name) DO UPDATE
+			SET json = excluded.json, fetched_at = excluded.fetched_at,
+				etag = excluded.etag, last_modified = excluded.last_modified
+			''', (endpoint, system_name, msgspec.json.encode(data), int(time.time()), etag, last_modified))
+			self.pending_writes += 1
+			if self.pending_writes >= CACHE_COMMIT_EVERY:
+				self.conn.commit()
+				self.pending_writes = 0
+
+	def is_empty(self) -> bool:
+		"""Check if nothing was cached yet"""
+		with self.lock:
+			return self.conn.execute("SELECT 1 FROM cache LIMIT 1").fetchone() is None
+
+	def import_legacy_dir(self, cache_dir: str) -> int:
+		"""
+		Import old per-file cache. Entries are keyed by the system name stored
+		in the payload, so the hashed file names never need to be recomputed.
+		"""
+		imported = 0
+		for entry in os.scandir(cache_dir):
+			endpoint, _, _ = entry.name.partition("_")
+			if endpoint not in ("bodies", "info") or not entry.name.endswith(".json"):
+				continue
+			try:
+				with open(entry.path, 'rb') as f:
+					data = msgspec.json.decode(f.read())
+			except (msgspec.DecodeError, OSError):
+				continue
+			# Empty replies for unknown systems don't carry a name
+			name = data.get("name") if isinstance(data, dict) else None
+			if not name:
+				continue
+			if endpoint == "bodies":
+				# Store only the fields SystemPayload declares
+				try:
+					data = msgspec.convert(data, SystemPayload)
+				except msgspec.ValidationError:
+					continue
+			with self.lock:
+				self.conn.execute('''
+				INSERT INTO cache (endpoint, name, json, fetched_at)
+				VALUES (?, ?, ?, ?)
+				ON CONFLICT (endpoint, name) DO NOTHING
+				''', (endpoint, name, msgspec.json.encode(data), int(entry.stat().st_mtime)))
+			imported += 1
+		self.flush()
+		return imported
+
+	def flush(self):
+		"""Commit pending writes"""
+		with self.lock:
+			self.conn.commit()
+			self.pending_writes = 0
+
+_cache = None
+
+def get_cache() -> CacheDB:
+	"""Open cache database on first use"""
+	global _cache
+	if _cache is None:
+		_cache = CacheDB(CACHE_DB)
+		if _cache.is_empty() and os.path.isdir(LEGACY_CACHE_DIR):
+			print(f"Importing old cache from {LEGACY_CACHE_DIR}...", file=sys.stderr)
+			imported = _cache.import_legacy_dir(LEGACY_CACHE_DIR)
+			print(f"Imported {imported} cache entries", file=sys.stderr)
+	return _cache
+
+def load_from_cache(system_name: str, endpoint: str, type: Any = Any) -> Optional[Any]:
+	"""Load data from cache if it exists and is valid"""
+	return get_cache().load(system_name, endpoint, type)
+
+def save_to_cache(system_name: str, endpoint: str, data: Any,
+				  etag: Optional[str] = None, last_modified: Optional[str] = None):
+	"""Save data to cache, with response validators if available"""
+	get_cache().save(system_name, endpoint, data, etag, last_modified)
+
+def fetch_bodies(system_name: str, refresh: bool = False) -> Optional[SystemPayload]:
+	"""
+	Fetch bodies (stars/planets) from EDSM with caching, None on error. With refresh,
+	cached entries are revalidated by a conditional request and kept if unchanged
+	or if the request fails.
+	"""
+	cached_data = load_from_cache(system_name, "bodies", SystemPayload)
+	if cached_data is not None and not refresh:
+		return cached_data
 	
 	url = "https://www.edsm.net/api-system-v1/bodies"
 	params = {"systemName": system_name}
+	headers = {}
+	if cached_data is not None:
+		etag, last_modified = get_cache().validators(system_name, "bodies")
+		if etag:
+			headers["If-None-Match"] = etag
+		if last_modified:
+			headers["If-Modified-Since"] = last_modified
 	try:
-		r = requests.get(url, params=params, timeout=15)
-		r.raise_for_status()
-		data = r.json()
-		save_to_cache(cache_file, data)
-		return data, True
-	except Exception as e:
-		error_data = {"error": str(e), "system": system_name, "msgnum": 999}
-		return error_data, True
-
-def fetch_info(system_name: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+		r = edsm_get(url, params, headers)
+		if r.status_code == 304:
+			return cached_data
+		data = msgspec.json.decode(r.content, type=SystemPayload)
+		save_to_cache(system_name, "bodies", data,
+					  r.headers.get("ETag"), r.headers.get("Last-Modified"))
+		return data
+	except Exception:
+		# Failed revalidation keeps cached entry
+		return cached_data
+
+def fetch_info(system_name: str) -> Optional[Dict[str, Any]]:
 	"""Fetch coords + information from EDSM with caching"""
-	cache_file = get_cache_filename(system_name, "info")
-	cached_data = load_from_cache(cache_file)
+	cached_data = load_from_cache(system_name, "info")
 	if cached_data is not None:
-		return cached_data, False
+		return cached_data
 	
 	url = "https://www.edsm.net/api-v1/system"
 	params = {
@@ -81,48 +335,108 @@ def fetch_info(system_name: str) -> Tuple[Optional[Dict[str, Any]], bool]:
 		"showPermit": 1
 	}
 	try:
-		r = requests.get(url, params=params, timeout=15)
-		r.raise_for_status()
-		data = r.json()
-		save_to_cache(cache_file, data)
-		return data, True
+		r = edsm_get(url, params)
+		data = msgspec.json.decode(r.content)
+		save_to_cache(system_name, "info", data)
+		return data
 	except Exception:
-		return None, True
+		return None
+
+def fetch_info_batch(system_names: list[str]) -> Dict[str, Any]:
+	"""Fetch coords + information for many systems, several per request, caching each one"""
+	url = "https://www.edsm.net/api-v1/systems"
+	results = {}
+	for start in range(0, len(system_names), INFO_BATCH_SIZE):
+		chunk = system_names[start:start + INFO_BATCH_SIZE]
+		params = [("systemName[]", name) for name in chunk]
+		params += [("showCoordinates", 1), ("showInformation", 1), ("showPermit", 1)]
+		try:
+			data = msgspec.json.decode(edsm_get(url, params).content)
+		except Exception as e:
+			# Systems of a failed batch fall back to single requests
+			print(f"Batch info request failed: {e}", file=sys.stderr)
+			continue
+		if data and not isinstance(data, list):
+			# Error object instead of system list, fall back to single requests as well
+			print(f"Batch info request failed: unexpected reply {data!r}", file=sys.stderr)
+			continue
+		# EDSM returns known systems only, with canonical name capitalization
+		by_name = {info.get("name", "").lower(): info
+				   for info in data or [] if isinstance(info, dict)}
+		for name in chunk:
+			# Unknown systems are stored like the empty reply of /api-v1/system
+			info = by_name.get(name.lower(), [])
+			save_to_cache(name, "info", info)
+			results[name] = info
+	return results
 
-def fetch_full_system(system_name: str) -> Tuple[Dict[str, Any], bool]:
-	"""Combine bodies + info into one structure with request tracking"""
-	bodies_data, bodies_requested = fetch_bodies(system_name)
+def prefetch_info(system_names: list[str], refresh: bool = False):
+	"""Fill info cache for all uncached (or, with refresh, all) systems using batched requests"""
+	cache = get_cache()
+	uncached = [name for name in system_names if refresh or not cache.contains(name, "info")]
+	if uncached:
+		print(f"Prefetching info for {len(uncached)} systems...", file=sys.stderr)
+		fetch_info_batch(uncached)
+		# Make entries visible to the read connections of fetch threads
+		cache.flush()
+
+def fetch_full_system(system_name: str, executor: ThreadPoolExecutor, refresh: bool = False) -> Optional[SystemPayload]:
+	"""Fetch bodies + info concurrently and combine into one structure"""
+	info_future = executor.submit(fetch_info, system_name)
+	bodies_data = fetch_bodies(system_name, refresh)
+	info_data = info_future.result()
 	
-	info_requested = False
-	# Only fetch info if we have valid system data
-	if "bodies" in bodies_data or "id" in bodies_data:
-		info_data, info_requested = fetch_info(system_name)
-		if info_data:
-			bodies_data["coords"] = info_data.get("coords")
-			bodies_data["information"] = info_data.get("information", {})
+	# Only enrich if we have valid system data
+	if info_data and bodies_data is not None and bodies_data.id:
+		bodies_data.coords = info_data.get("coords")
+		bodies_data.information = info_data.get("information", {})
 	
-	total_requested = bodies_requested or info_requested
-	return bodies_data, total_requested
+	return bodies_data
+
+def fetch_systems(system_names: list[str], refresh: bool = False):
+	"""
+	Fetch systems with up to PREFETCH_WINDOW in progress, yield (name, data) in input order.
+	Cache hits overlap freely, EDSM requests are bounded by MAX_HTTP_IN_FLIGHT.
+	"""
+	prefetch_info(system_names, refresh)
+	pending = deque()
+	try:
+		with ThreadPoolExecutor(max_workers=PREFETCH_WINDOW) as system_pool, \
+				ThreadPoolExecutor(max_workers=PREFETCH_WINDOW) as info_pool:
+			for sys_name in system_names:
+				pending.append((sys_name, system_pool.submit(fetch_full_system, sys_name, info_pool, refresh)))
+				if len(pending) >= PREFETCH_WINDOW:
+					name, future = pending.popleft()
+					yield name, future.result()
+			while pending:
+				name, future = pending.popleft()
+				yield name, future.result()
+	finally:
+		get_cache().flush()
 
 def extract_matches(input_file, pattern):
 	"""
-	Process input file and return all regex matches as a list
+	Scan whole input file in one pass and return all regex matches as a list
 	
 	Args:
-		input_file: File-like object to read from
-		pattern: Compiled regex pattern
+		input_file: Binary file-like object to read from
+		pattern: Compiled bytes regex pattern, match in group 1
 	
 	Returns:
 		List of matched strings
 	"""
-	matches = []
-	for line in input_file:
-		match = pattern.search(line)
-		if match:
-			matches.append(match.group(0))
-	return matches
-
-@dataclass
+	try:
+		data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		# Empty files, pipes and stdin can't be mapped
+		data = input_file.read()
+	try:
+		return [match.group(1).decode('utf-8', errors='replace') for match in pattern.finditer(data)]
+	finally:
+		if isinstance(data, mmap.mmap):
+			data.close()
+
+@dataclass(slots=True)
 class PlanetData:
 	name: str
 	mainStar: str
@@ -139,6 +453,13 @@ class PlanetData:
 	numWws: int = 0
 	numBlackHoles: int = 0
 	numNStars: int = 0
+	_score: int = field(init=False, repr=False, default=0)
+	_rendered: str = field(init=False, repr=False, default="")
+
+	def __post_init__(self):
+		# Computed once: used for sorting and printed several times
+		self._score = self.computeScore()
+		self._rendered = self.renderStats()
 
 	# def getScore(self):
 	# 	result = 0
@@ -153,9 +474,11 @@ class PlanetData:
 	# 	result += self.numNStars * 20
 	# 	return result
 	def getScore(self):
-		badStarClasses = ["T (Brown dwarf) Star"]
+		return self._score
+
+	def computeScore(self):
 		result = 0
-		if self.mainStar in badStarClasses:
+		if self.mainStar in BAD_STAR_CLASSES:
 			result -= 10
 		result += self.numStars
 		result += self.numPlanets
@@ -172,145 +495,114 @@ class PlanetData:
 		return result
 
 	def writeStats(self, output):
-		output.write(f"{self.name}\n")
-		output.write(f"Score: {self.getScore()}\n")
-		output.write(f"Main star: {self.mainStar}\n")
-		output.write(f"{self.url}\n")
+		output.write(self._rendered)
+
+	def renderStats(self):
+		parts = [
+			self.name,
+			f"Score: {self.getScore()}",
+			f"Main star: {self.mainStar}",
+			self.url,
+		]
 		if self.numStars > 0:
-			output.write(f"Stars: {self.numStars}\n")
+			parts.append(f"Stars: {self.numStars}")
 		if self.numPlanets > 0:
-			output.write(f"Planets: {self.numPlanets}\n")
+			parts.append(f"Planets: {self.numPlanets}")
 		if self.numLandable > 0:
-			output.write(f"Landable: {self.numLandable}\n")
+			parts.append(f"Landable: {self.numLandable}")
 		if self.numBlackHoles > 0:
-			output.write(f"(!)Black Holes: {self.numBlackHoles}\n")
+			parts.append(f"(!)Black Holes: {self.numBlackHoles}")
 		if self.numNStars > 0:
-			output.write(f"(!)Neutron Stars: {self.numNStars}\n")
+			parts.append(f"(!)Neutron Stars: {self.numNStars}")
 		if self.numAtmosphere > 0:
-			output.write(f"Atmosphere: {self.numAtmosphere}\n")
+			parts.append(f"Atmosphere: {self.numAtmosphere}")
 		if self.numBelts > 0:
-			output.write(f"Belts: {self.numBelts}\n")
+			parts.append(f"Belts: {self.numBelts}")
 		if self.numRings > 0:
-			output.write(f"Rings: {self.numRings}\n")
+			parts.append(f"Rings: {self.numRings}")
 		if self.numRocky > 0:
-			output.write(f"Rocky: {self.numRocky}\n")
+			parts.append(f"Rocky: {self.numRocky}")
 		if self.numHmc > 0:
-			output.write(f"HMC: {self.numHmc}\n")
+			parts.append(f"HMC: {self.numHmc}")
 		if self.numElws > 0:
-			output.write(f"Earth-like: {self.numElws}\n")
+			parts.append(f"Earth-like: {self.numElws}")
 		if self.numWws > 0:
-			output.write(f"Water-worlds: {self.numWws}\n")
+			parts.append(f"Water-worlds: {self.numWws}")
+		return "\n".join(parts) + "\n"
 
-def filter_system_names(system_names: list[str]):
+def filter_system_names(system_names: list[str], refresh: bool = False):
 	"""
 	Process system names and yield interesting planets
 	"""
 	total = len(system_names)
 
-	for idx, sys_name in enumerate(system_names, 1):
-		print(f"[{idx}/{total}] Fetching {sys_name}...", file=sys.stderr)
-		data, requested = fetch_full_system(sys_name)
+	for idx, (sys_name, data) in enumerate(fetch_systems(system_names, refresh), 1):
+		print(f"[{idx}/{total}] Fetched {sys_name}", file=sys.stderr)
 		
 		# Skip processing if no valid data
-		if not data or ("msgnum" in data and data["msgnum"] != 100):
+		if data is None or not data.id:
 			print(f"No valid data for {sys_name}", file=sys.stderr)
-			# Sleep only if we made actual requests
-			if idx < total and requested:
-				time.sleep(1)
 			continue
 
-		starCount = 0
-		planetCount = 0
 		starType = ''
-		numBodies = data.get('bodyCount', 0)
-		url = data.get('url', "")
-		bodies = data.get('bodies', [])
-		numLandable = 0
-		numAtmosphere = 0
-		numRings = 0
-		numBelts = 0
-		numHmc = 0
-		numRocky = 0
-		numWws = 0
-		numElws = 0
-		numBhs = 0
-		numNeutrons = 0
-		
+		numBodies = data.bodyCount
+		url = data.url
+		bodies = data.bodies
+		counts = [0] * NUM_COUNTERS
+		starGet = STAR_SUBTYPE_COUNTER.get
+		planetGet = PLANET_SUBTYPE_COUNTER.get
+		landableGet = LANDABLE_SUBTYPE_COUNTER.get
 		
 		for body in bodies:
-			bodyType = body.get('type', '')
+			bodyType = body.type
 			if bodyType == 'Star':
-				starCount += 1
-				subType = body.get("subType", "")
-				if subType == "Black Hole":
-					numBhs += 1
-				elif subType == "Neutron Star":
-					numNeutrons += 1
-				if belts := body.get("belts", None):
-					numBelts += len(belts)
-				if body.get('isMainStar', False):
-					starType = body.get('subType', '')
+				subType = body.subType
+				counts[NUM_STARS] += 1
+				counter = starGet(subType)
+				if counter is not None:
+					counts[counter] += 1
+				if body.belts:
+					counts[NUM_BELTS] += len(body.belts)
+				if body.isMainStar:
+					starType = subType
 			elif bodyType == 'Planet':
-				subType = body.get("subType", "")
-				landable = body.get('isLandable', False)
-				if rings := body.get("rings", None):
-					# numRings += 1
-					numRings += len(rings)
-				if subType == "Water world":
-					numWws += 1
-				elif subType == "Rocky body":
-					if landable:
-						numRocky += 1
-				elif subType == "High metal content world":
-					if landable:
-						numHmc += 1
-				elif subType == "Earth-like world":
-					numElws += 1
-				if landable:
-					numLandable += 1
-					if body.get('atmosphereType', "") != "No atmosphere":
-						numAtmosphere += 1
-				planetCount += 1
-
-		if (planetCount > 0) and ((numLandable > 0) or (numAtmosphere > 0)):
-			tmp = PlanetData(
-				name=sys_name,
-				mainStar=starType,
-				url=url,
-				numStars=starCount,
-				numPlanets=planetCount,
-				numLandable=numLandable,
-				numAtmosphere=numAtmosphere,
-				numRings=numRings,
-				numBelts=numBelts,
-				numRocky=numRocky,
-				numHmc=numHmc,
-				numElws=numElws,
-				numWws=numWws,
-				numBlackHoles=numBhs,
-				numNStars=numNeutrons
-			)
+				subType = body.subType
+				counts[NUM_PLANETS] += 1
+				if body.rings:
+					counts[NUM_RINGS] += len(body.rings)
+				counter = planetGet(subType)
+				if counter is not None:
+					counts[counter] += 1
+				if body.isLandable:
+					counts[NUM_LANDABLE] += 1
+					counter = landableGet(subType)
+					if counter is not None:
+						counts[counter] += 1
+					if body.atmosphereType != NO_ATMOSPHERE:
+						counts[NUM_ATMOSPHERE] += 1
+
+		if (counts[NUM_PLANETS] > 0) and ((counts[NUM_LANDABLE] > 0) or (counts[NUM_ATMOSPHERE] > 0)):
+			tmp = PlanetData(sys_name, starType, url, *counts)
 			yield tmp
-		
-		# Sleep only if we made actual API requests and not on last item
-		if idx < total and requested:
-			time.sleep(1)
 
 def main():
 	parser = argparse.ArgumentParser(description='Extract system names from log files')
-	parser.add_argument('input', type=argparse.FileType('r'), help='Input logfile to process')
+	parser.add_argument('input', type=argparse.FileType('rb'), help='Input logfile to process')
 	parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout,
 						help='Output file (default: stdout)')
+	parser.add_argument('--refresh', action='store_true',
+						help='Revalidate cached systems with EDSM instead of trusting the cache')
 	
 	args = parser.parse_args()
 	
-	# Fixed regex pattern with decimal numbers only
-	pattern = re.compile(r'(?<=System: ).*(?= \(ID64: [0-9]+\))')
+	# Fixed regex pattern with decimal numbers only, system name in group 1.
+	# No lookbehind: the literal prefix lets the engine skip to candidate positions
+	pattern = re.compile(rb'System: (.*?) \(ID64: [0-9]+\)')
 	
 	try:
-		# Get all matches as a list
-		matches = extract_matches(args.input, pattern)
-		filtered = filter_system_names(matches)
+		# Get all matches as a list, without repeats (order preserved)
+		matches = list(dict.fromkeys(extract_matches(args.input, pattern)))
+		filtered = filter_system_names(matches, args.refresh)
 		
 		scored = []
 		# Output results
@@ -326,14 +618,12 @@ def main():
 			args.output.write(f"{'-'*40}\n")
 			scored.append(cur)
 
-		scored = sorted(scored, key=lambda x: -x.getScore())
-		args.output.write(f"{'='*40}:\n")
-		args.output.write(f"Sorted: {len(scored)}:\n")
-		args.output.write(f"{'='*40}:\n")
+		# Stable in-place sort, equal scores keep fetch order
+		scored.sort(key=attrgetter('_score'), reverse=True)
+		args.output.write(f"{'='*40}:\nSorted: {len(scored)}:\n{'='*40}:\n")
 
 		for cur in scored:
-			args.output.write(f"{cur.name}: {cur.getScore()}\n")
-			args.output.write(f"{'-'*40}\n")
+			args.output.write(f"{cur.name}: {cur.getScore()}\n{'-'*40}\n")
 			cur.writeStats(args.output)
 			args.output.write(f"{'='*40}\n")		
 			
@@ -1,19 +1,75 @@
 #!/usr/bin/env python3
 import gzip
-import ijson
+import json
+import os
 import sqlite3
 import sys
 import time
+import queue
+import threading
 import datetime
-from math import floor, sqrt
+from math import sqrt
+import numpy as np
 import argparse
-from dataclasses import dataclass
-from typing import Optional, List, Tuple, Union, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.request import pathname2url
+from typing import Optional, List, Tuple, Union, Dict, NamedTuple
 
-GRID = 25.0
+# C-backed parser, pure python backend is several times slower on dumps
+try:
+	import ijson.backends.yajl2_c as ijson
+except ImportError:
+	try:
+		import ijson.backends.yajl2_cffi as ijson
+	except ImportError:
+		import ijson
 
-@dataclass
-class SystemData:
+INSERT_BATCH_SIZE = 5000  # Rows per executemany() call in bulk loaders
+READ_BLOCK_SIZE = 1 << 20  # Bytes per block decompressed ahead of the parser
+READ_AHEAD_BLOCKS = 4  # Decompressed blocks queued for the parser
+CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+
+# Secondary indexes: (name, table, columns)
+INDEXES = (
+	("idx_sys_name", "systems", "name"),
+	# Covers population columns of faction queries, no table lookups needed
+	("idx_controlling_faction_cover", "population_data",
+	 "controllingFaction, population, security, primaryEconomy, secondaryEconomy"),
+)
+# Indexes created by older versions, superseded by INDEXES
+OBSOLETE_INDEXES = ("idx_controlling_faction",)
+
+# Bulk loader statements, prepared once per connection and reused by executemany().
+# Upserts update existing rows in place and skip unchanged ones, so indexes and
+# spatial index are only touched for rows that really changed.
+INSERT_SYSTEM_SQL = '''
+INSERT INTO systems 
+(id64, x, y, z, name, main_star)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (id64) DO UPDATE SET
+	x = excluded.x, y = excluded.y, z = excluded.z,
+	name = excluded.name, main_star = excluded.main_star
+WHERE excluded.x IS NOT systems.x OR excluded.y IS NOT systems.y OR excluded.z IS NOT systems.z
+	OR excluded.name IS NOT systems.name OR excluded.main_star IS NOT systems.main_star
+'''
+INSERT_POPULATION_SQL = '''
+INSERT INTO population_data 
+(id64, population, security, controllingFaction, 
+ primaryEconomy, secondaryEconomy)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (id64) DO UPDATE SET
+	population = excluded.population, security = excluded.security,
+	controllingFaction = excluded.controllingFaction,
+	primaryEconomy = excluded.primaryEconomy, secondaryEconomy = excluded.secondaryEconomy
+WHERE excluded.population IS NOT population_data.population
+	OR excluded.security IS NOT population_data.security
+	OR excluded.controllingFaction IS NOT population_data.controllingFaction
+	OR excluded.primaryEconomy IS NOT population_data.primaryEconomy
+	OR excluded.secondaryEconomy IS NOT population_data.secondaryEconomy
+'''
+
+class SystemData(NamedTuple):
 	id64: int
 	x: float
 	y: float
@@ -21,8 +77,7 @@ class SystemData:
 	name: str
 	mainStar: str
 
-@dataclass
-class PopulationData:
+class PopulationData(NamedTuple):
 	id64: int
 	population: Optional[int]
 	security: str
@@ -30,131 +85,224 @@ class PopulationData:
 	primaryEconomy: str
 	secondaryEconomy: str
 
-class AdaptiveUpdateTracker:
-	"""Tracks record processing progress and triggers commits based on count/time thresholds.
-	Dynamically adjusts time-check frequency for optimal performance."""
+class ProgressTracker:
+	"""Tracks record processing progress and triggers progress reports: after max_batch_size
+	records, or after max_wait seconds once at least min_batch_size records are pending."""
 	
-	def __init__(self, batch_size, time_interval=5.0, initial_time_check_batch=100,
-				 min_time_check_batch=10, max_time_check_batch=10000, rate_smoothing=0.3):
+	def __init__(self, min_batch_size=INSERT_BATCH_SIZE, max_batch_size=50_000, max_wait=5.0):
 		"""
-		Initialize adaptive tracker.
+		Initialize progress tracker.
 		
 		Args:
-			batch_size (int): Commit after processing this many records.
-			time_interval (float): Max seconds between commits (default: 5.0).
-			initial_time_check_batch (int): Initial record count between time checks (default: 100).
-			min_time_check_batch (int): Minimum records between time checks (default: 10).
-			max_time_check_batch (int): Maximum records between time checks (default: 10000).
-			rate_smoothing (float): EMA smoothing factor for rate calculation (0.0-1.0, default: 0.3).
+			min_batch_size (int): Never report fewer new records than this (default: INSERT_BATCH_SIZE).
+			max_batch_size (int): Always report after this many records (default: 50000).
+			max_wait (float): Max seconds between reports once min_batch_size is reached (default: 5.0).
 		"""
-		self.batch_size = batch_size
-		self.time_interval = time_interval
-		self.time_check_batch = initial_time_check_batch
-		self.min_time_check_batch = min_time_check_batch
-		self.max_time_check_batch = max_time_check_batch
-		self.rate_smoothing = rate_smoothing
-		
-		self.start_time = time.time()
-		self.last_commit_time = self.start_time
-		self.last_commit_total = 0  # Records count at last commit
+		self.min_batch_size = min_batch_size
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		
+		self.start_time = time.monotonic()
+		self.last_report_time = self.start_time
+		self.pending_count = 0  # Records since last report
 		self.total_count = 0
-		self.records_since_time_check = 0
-		self.ema_rate = None  # Exponential moving average of processing rate
 
-	def should_commit(self):
-		"""Increment record count and determine if commit is needed."""
-		self.total_count += 1
-		self.records_since_time_check += 1
+	def should_report(self, count):
+		"""Add count processed records and determine if progress report is due."""
+		self.total_count += count
+		self.pending_count += count
+		if self.pending_count < self.min_batch_size:
+			return False
 		
-		# Check batch condition
-		if self.batch_size > 0 and self.total_count % self.batch_size == 0:
-			self._reset_timer()
+		current_time = time.monotonic()
+		if (self.pending_count >= self.max_batch_size or
+				current_time - self.last_report_time >= self.max_wait):
+			self.last_report_time = current_time
+			self.pending_count = 0
 			return True
-		
-		# Periodically check time condition
-		if self.records_since_time_check >= self.time_check_batch:
-			self.records_since_time_check = 0
-			if time.time() - self.last_commit_time >= self.time_interval:
-				self._reset_timer()
-				return True
-		
 		return False
 
-	def _reset_timer(self):
-		"""Update commit timestamp, reset counters, and adaptively adjust time_check_batch."""
-		current_time = time.time()
-		elapsed = current_time - self.last_commit_time
-		records_since_commit = self.total_count - self.last_commit_total
-
-		# Update EMA of processing rate (records/sec)
-		if elapsed > 0 and records_since_commit > 0:
-			current_rate = records_since_commit / elapsed
-			if self.ema_rate is None:
-				self.ema_rate = current_rate
-			else:
-				self.ema_rate = (
-					self.rate_smoothing * current_rate +
-					(1 - self.rate_smoothing) * self.ema_rate
-				)
-			
-			# Calculate new time_check_batch: aim for 1 time-check per time_interval seconds
-			new_batch = self.ema_rate * self.time_interval
-			self.time_check_batch = int(round(
-				max(self.min_time_check_batch, min(self.max_time_check_batch, new_batch))
-			))
-
-		# Reset state for next interval
-		self.last_commit_time = current_time
-		self.last_commit_total = self.total_count
-		self.records_since_time_check = 0
-
 	def print_stats(self, item_type, final=False):
 		"""Print processing statistics with context-appropriate messaging."""
-		elapsed = time.time() - self.start_time
+		elapsed = time.monotonic() - self.start_time
 		rate = self.total_count / elapsed if elapsed > 0 else 0
 		
 		if final:
 			prefix = f'Done. Total {item_type}: {self.total_count:,}'
 		else:
-			prefix = f'{self.total_count:,} {item_type} updated …'
+			prefix = f'{self.total_count:,} {item_type} processed …'
 		
 		print(prefix)
 		print(f"Elapsed time: {elapsed:.2f}s ({datetime.timedelta(seconds=int(elapsed))})")
 		print(f"Average rate: {rate:.1f} {item_type}/second")
-		print(f"Current time-check batch: {self.time_check_batch}")
-		
-def gkey(x, y, z):
-	"""Calculate grid coordinates from full coordinates"""
-	return (int(floor(x/GRID)), int(floor(y/GRID)), int(floor(z/GRID)))
+
+class ReadAheadReader:
+	"""File-like reader that decompresses ahead of the consumer in a background thread.
+	zlib releases the GIL, so gzip decompression overlaps with JSON parsing."""
+
+	def __init__(self, f, block_size=READ_BLOCK_SIZE, max_blocks=READ_AHEAD_BLOCKS):
+		"""
+		Start reading ahead.
+
+		Args:
+			f: Binary file-like object to read from.
+			block_size (int): Bytes per read from f (default: READ_BLOCK_SIZE).
+			max_blocks (int): Blocks read ahead before the thread waits (default: READ_AHEAD_BLOCKS).
+		"""
+		self.f = f
+		self.block_size = block_size
+		self.blocks = queue.Queue(maxsize=max_blocks)
+		self.stopped = threading.Event()
+		self.block = b''
+		self.pos = 0
+		self.eof = False
+		self.thread = threading.Thread(target=self._produce, daemon=True)
+		self.thread.start()
+
+	def _put(self, item):
+		"""Queue item, give up once reader is closed"""
+		while not self.stopped.is_set():
+			try:
+				self.blocks.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _produce(self):
+		try:
+			while True:
+				block = self.f.read(self.block_size)
+				if not self._put(block) or not block:
+					return
+		except Exception as e:
+			# Re-raised by read() in the consumer thread
+			self._put(e)
+
+	def _fill(self):
+		"""Take next block once current one is consumed, False at end of file"""
+		while self.pos >= len(self.block) and not self.eof:
+			item = self.blocks.get()
+			if isinstance(item, Exception):
+				self.eof = True
+				raise item
+			self.block, self.pos = item, 0
+			self.eof = not item
+		return self.pos < len(self.block)
+
+	def read(self, size=-1):
+		"""Read up to size bytes, or up to end of file if size is negative. b'' at end of file"""
+		if size < 0:
+			parts = []
+			while self._fill():
+				parts.append(self.block[self.pos:])
+				self.pos = len(self.block)
+			return b''.join(parts)
+		self._fill()
+		data = self.block[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def close(self):
+		"""Stop read-ahead thread"""
+		self.stopped.set()
+		self.thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+@contextmanager
+def open_gz_dump(path):
+	"""Open gzipped JSON dump for parsing, decompressing ahead when there's a spare core"""
+	with gzip.open(path, 'rb') as gz:
+		if (os.cpu_count() or 1) < 2:
+			# Read-ahead thread would only compete with the parser
+			yield gz
+			return
+		with ReadAheadReader(gz) as f:
+			yield f
 
 def is_any_faction(name: str) -> bool:
 	return name == "ANY"
 
 class GalaxyDatabase:
-	def __init__(self, db_path, restore_from=None):
+	def __init__(self, db_path, restore_from=None, bulk_load=False):
+		"""
+		Open database, creating it if needed.
+		
+		Args:
+			db_path (str): Database file path or ':memory:'.
+			restore_from (str): Copy this database file in before use (default: None).
+			bulk_load (bool): Tune connection for a single writer loading dumps,
+				locks out other connections until closed (default: False).
+		"""
 		self.db_path = db_path
+		self.bulk_load = bulk_load
 		self.conn = None
+		self.ro_conn = None
 		self._connect()
 		self._configure_connection()
 		if restore_from:
 			self._restore_from_file(restore_from)
 		self._initialize_schema()
+		self._connect_read_only()
 
 	def _connect(self):
 		"""Establish database connection"""
 		if self.conn:
 			self.conn.close()
-		self.conn = sqlite3.connect(self.db_path)
+		self.conn = sqlite3.connect(self.db_path, cached_statements=CACHED_STATEMENTS)
+
+	def _connect_read_only(self):
+		"""
+		Open separate read-only connection for queries, so they don't serialize with
+		writes on the main connection. In-memory and bulk load databases (locked
+		exclusively) can't be shared and are queried through the main connection.
+		"""
+		self.ro_conn = self._open_read_only() if self._can_share() else self.conn
+
+	def _can_share(self):
+		"""True if other connections can read the database"""
+		return self.db_path != ':memory:' and not self.bulk_load
+
+	def _open_read_only(self):
+		"""Open new read-only connection to database file"""
+		uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+		conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+							   cached_statements=CACHED_STATEMENTS)
+		pragmas = [
+			("query_only", "1"),
+			("cache_size", "-100000"),  # 100MB cache
+			("temp_store", "MEMORY"),
+			("mmap_size", "1073741824")  # 1GB mmap
+		]
+		cursor = conn.cursor()
+		for key, value in pragmas:
+			cursor.execute(f"PRAGMA {key} = {value}")
+		return conn
 
 	def _configure_connection(self):
 		"""Apply performance optimizations to connection"""
 		pragmas = [
-			("journal_mode", "WAL"),
+			("page_size", "16384"),  # Only applies to new database, must precede WAL
 			("synchronous", "NORMAL"),
 			("cache_size", "-100000"),  # 100MB cache
 			("temp_store", "MEMORY"),
-			("mmap_size", "1073741824")  # 1GB mmap
 		]
+		if self.db_path != ':memory:':
+			# Meaningless for in-memory database
+			pragmas += [
+				("journal_mode", "WAL"),
+				("mmap_size", "1073741824"),  # 1GB mmap
+				("journal_size_limit", "268435456")  # Truncate WAL to 256MB after checkpoints
+			]
+			if self.bulk_load:
+				pragmas += [
+					("locking_mode", "EXCLUSIVE")  # Sole writer, skip per-transaction locking
+				]
 		cursor = self.conn.cursor()
 		for key, value in pragmas:
 			cursor.execute(f"PRAGMA {key} = {value}")
@@ -162,6 +310,14 @@ class GalaxyDatabase:
 
 	def _initialize_schema(self):
 		self._create_tables()
+		self._migrate_grid_columns()
+		for name in OBSOLETE_INDEXES:
+			self.conn.execute(f"DROP INDEX IF EXISTS {name}")
+		if self._is_empty('systems_rtree') and not self._is_empty('systems'):
+			# Initial load was interrupted before spatial index was filled
+			print("Building spatial index")
+			self._fill_rtree()
+			self.conn.commit()
 		self.create_indexes()
 
 	def _create_tables(self):
@@ -169,18 +325,32 @@ class GalaxyDatabase:
 		cursor = self.conn.cursor()
 		
 		# Existing systems table
+		self._create_systems_table('systems')
+		
+		# Spatial index of systems, points stored as zero-size boxes
 		cursor.execute('''
-		CREATE TABLE IF NOT EXISTS systems (
-			id64 INTEGER PRIMARY KEY,
-			grid_x INTEGER NOT NULL,
-			grid_y INTEGER NOT NULL, 
-			grid_z INTEGER NOT NULL,
-			x REAL NOT NULL,
-			y REAL NOT NULL,
-			z REAL NOT NULL,
-			name TEXT NOT NULL,
-			main_star TEXT NOT NULL
-		)
+		CREATE VIRTUAL TABLE IF NOT EXISTS systems_rtree
+		USING rtree(id64, minX, maxX, minY, maxY, minZ, maxZ)
+		''')
+		
+		self._create_rtree_insert_trigger()
+		
+		# Keep spatial index in sync with updated and deleted systems
+		cursor.execute('''
+		CREATE TRIGGER IF NOT EXISTS systems_rtree_update AFTER UPDATE OF x, y, z ON systems
+		WHEN old.x IS NOT new.x OR old.y IS NOT new.y OR old.z IS NOT new.z
+		BEGIN
+			UPDATE systems_rtree
+			SET minX = new.x, maxX = new.x, minY = new.y, maxY = new.y, minZ = new.z, maxZ = new.z
+			WHERE id64 = new.id64;
+		END
+		''')
+		
+		cursor.execute('''
+		CREATE TRIGGER IF NOT EXISTS systems_rtree_delete AFTER DELETE ON systems
+		BEGIN
+			DELETE FROM systems_rtree WHERE id64 = old.id64;
+		END
 		''')
 		
 		# New population data table
@@ -198,82 +368,121 @@ class GalaxyDatabase:
 		self.conn.commit()
 		pass
 
-	def drop_indexes(self):
-		"""Drop indexes if they exist"""
-		cursor = self.conn.cursor()
+	def _create_systems_table(self, name):
+		"""Create systems table under given name if it doesn't exist"""
+		self.conn.execute(f'''
+		CREATE TABLE IF NOT EXISTS {name} (
+			id64 INTEGER PRIMARY KEY,
+			x REAL NOT NULL,
+			y REAL NOT NULL,
+			z REAL NOT NULL,
+			name TEXT NOT NULL,
+			main_star TEXT NOT NULL
+		)
+		''')
 
-		# Indexes for systems table
-		cursor.execute('''
-		DROP INDEX IF EXISTS idx_grid_coords
+	def _create_rtree_insert_trigger(self):
+		"""Add inserted systems to spatial index"""
+		self.conn.execute('''
+		CREATE TRIGGER IF NOT EXISTS systems_rtree_insert AFTER INSERT ON systems
+		BEGIN
+			INSERT OR REPLACE INTO systems_rtree
+			VALUES (new.id64, new.x, new.x, new.y, new.y, new.z, new.z);
+		END
 		''')
-		
-		cursor.execute('''
-		DROP INDEX IF EXISTS idx_sys_name
+
+	def _fill_rtree(self):
+		"""Add all systems to spatial index"""
+		self.conn.execute('''
+		INSERT OR REPLACE INTO systems_rtree
+		SELECT id64, x, x, y, y, z, z FROM systems
 		''')
 
-		# Indexes for population_data table
+	def _migrate_grid_columns(self):
+		"""Replace grid columns of databases built by older versions with the R*Tree index"""
+		cursor = self.conn.cursor()
+		columns = {row[1] for row in cursor.execute("PRAGMA table_info(systems)")}
+		if "grid_x" not in columns:
+			return
+		
+		print("Migrating systems table to R*Tree spatial index, this copies the whole table once")
+		start = time.time()
+		cursor.execute("BEGIN IMMEDIATE")
+		self._create_systems_table('systems_new')
 		cursor.execute('''
-		DROP INDEX IF EXISTS idx_controlling_faction 
+		INSERT INTO systems_new (id64, x, y, z, name, main_star)
+		SELECT id64, x, y, z, name, main_star FROM systems
 		''')
-		
+		# Also drops grid index, name index and triggers of old table
+		cursor.execute("DROP TABLE systems")
+		cursor.execute("ALTER TABLE systems_new RENAME TO systems")
+		self._fill_rtree()
+		self.conn.commit()
+		self._create_tables()
+		delta = datetime.timedelta(seconds=(time.time() - start))
+		print(f"Migration complete in {delta}")
+
+	def drop_indexes(self, table=None):
+		"""Drop indexes if they exist, only those of table if given"""
+		cursor = self.conn.cursor()
+		for name, index_table, _ in INDEXES:
+			if table is None or table == index_table:
+				cursor.execute(f"DROP INDEX IF EXISTS {name}")
 		self.conn.commit()
-		pass
 
 	def create_indexes(self):
 		"""Create indexes if they don't exist"""
 		cursor = self.conn.cursor()
+		for name, table, columns in INDEXES:
+			cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+		self.conn.commit()
 
-		# Indexes for systems table
-		cursor.execute('''
-		CREATE INDEX IF NOT EXISTS idx_grid_coords 
-		ON systems (grid_x, grid_y, grid_z)
-		''')
-		
-		# cursor.execute('''
-		# CREATE INDEX IF NOT EXISTS idx_id64 
-		# ON systems (id64)
-		# ''')		
-		
-		cursor.execute('''
-		CREATE INDEX IF NOT EXISTS idx_sys_name 
-		ON systems (name)
-		''')
+	def _is_empty(self, table):
+		"""True if table has no rows"""
+		return self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
 
-		# Indexes for population_data table
-		cursor.execute('''
-		CREATE INDEX IF NOT EXISTS idx_controlling_faction 
-		ON population_data (controllingFaction)
-		''')
-		
+	def _begin_bulk_load(self, table):
+		"""
+		Drop indexes of an empty table before loading it, building them once
+		afterwards is much cheaper than updating them per row. Incremental
+		updates of a filled table keep its indexes. Returns True if dropped.
+		"""
+		if not self._is_empty(table):
+			return False
+		print(f"Table {table} is empty, indexes will be built after loading")
+		self.drop_indexes(table)
+		if table == 'systems':
+			self.conn.execute("DROP TRIGGER IF EXISTS systems_rtree_insert")
+			self.conn.commit()
+		return True
+
+	def _end_bulk_load(self, table, indexes_dropped):
+		"""Rebuild indexes dropped by _begin_bulk_load and refresh planner statistics"""
+		if indexes_dropped:
+			print("Building indexes")
+			if table == 'systems':
+				self._fill_rtree()
+				self._create_rtree_insert_trigger()
+			self.create_indexes()
+		self.conn.execute("ANALYZE")
 		self.conn.commit()
-		pass
 
-	def query_grid_cell_range(self, min_gx, max_gx, min_gy, max_gy, min_gz, max_gz):
-		"""Query all systems in a range of grid cells"""
-		cursor = self.conn.cursor()
+	def query_box_rows(self, min_x, max_x, min_y, max_y, min_z, max_z):
+		"""Query all systems inside a coordinate box as raw (id64, x, y, z, name, main_star) rows"""
+		cursor = self.ro_conn.cursor()
 		cursor.execute('''
-		SELECT id64, x, y, z, name, main_star 
-		FROM systems 
-		WHERE grid_x BETWEEN ? AND ? 
-		  AND grid_y BETWEEN ? AND ?
-		  AND grid_z BETWEEN ? AND ?
-		''', (min_gx, max_gx, min_gy, max_gy, min_gz, max_gz))
-		
-		return [
-			SystemData(
-				id64=row[0],
-				x=row[1],
-				y=row[2],
-				z=row[3],
-				name=row[4],
-				mainStar=row[5]
-			)
-			for row in cursor.fetchall()
-		]
+		SELECT s.id64, s.x, s.y, s.z, s.name, s.main_star 
+		FROM systems_rtree r
+		JOIN systems s ON s.id64 = r.id64
+		WHERE r.maxX >= ? AND r.minX <= ?
+		  AND r.maxY >= ? AND r.minY <= ?
+		  AND r.maxZ >= ? AND r.minZ <= ?
+		''', (min_x, max_x, min_y, max_y, min_z, max_z))
+		return cursor.fetchall()
 
 	def get_system_by_id64(self, id64):
 		"""Get system details by id64"""
-		cursor = self.conn.cursor()
+		cursor = self.ro_conn.cursor()
 		cursor.execute('''
 		SELECT id64, x, y, z, name, main_star
 		FROM systems
@@ -284,18 +493,11 @@ class GalaxyDatabase:
 		if not row:
 			return None
 			
-		return SystemData(
-			id64=row[0],
-			x=row[1],
-			y=row[2],
-			z=row[3],
-			name=row[4],
-			mainStar=row[5]
-		)
+		return SystemData._make(row)
 
 	def get_system_by_name(self, name):
 		"""Get system details by name"""
-		cursor = self.conn.cursor()
+		cursor = self.ro_conn.cursor()
 		cursor.execute('''
 		SELECT id64, x, y, z, name, main_star
 		FROM systems
@@ -306,18 +508,11 @@ class GalaxyDatabase:
 		if not row:
 			return None
 			
-		return SystemData(
-			id64=row[0],
-			x=row[1],
-			y=row[2],
-			z=row[3],
-			name=row[4],
-			mainStar=row[5]
-		)
+		return SystemData._make(row)
 
 	def get_population_by_id64(self, id64):
 		"""Get population data by id64"""
-		cursor = self.conn.cursor()
+		cursor = self.ro_conn.cursor()
 		cursor.execute('''
 		SELECT id64, population, security, controllingFaction, 
 			   primaryEconomy, secondaryEconomy
@@ -329,40 +524,33 @@ class GalaxyDatabase:
 		if not row:
 			return None
 			
-		return PopulationData(
-			id64=row[0],
-			population=row[1],
-			security=row[2],
-			controllingFaction=row[3],
-			primaryEconomy=row[4],
-			secondaryEconomy=row[5]
-		)
+		return PopulationData._make(row)
 		
+	def _select_by_id64s(self, sql, id64_list):
+		"""
+		Run sql for unique ids of id64_list. Ids are bound as one JSON array,
+		sql unpacks it with "IN (SELECT value FROM json_each(?))".
+		One statement regardless of id count, no SQLite variable limit.
+		"""
+		cursor = self.ro_conn.cursor()
+		cursor.execute(sql, (json.dumps(list(set(id64_list))),))
+		return cursor.fetchall()
+
 	def get_systems_by_id64s(self, id64_iterable):
 		"""Get system details for multiple id64 values (preserves input order)"""
 		id64_list = list(id64_iterable)
 		if not id64_list:
 			return []
 		
-		unique_ids = set(id64_list)
-		placeholders = ','.join('?' * len(unique_ids))
-		cursor = self.conn.cursor()
-		cursor.execute(f'''
+		rows = self._select_by_id64s('''
 			SELECT id64, x, y, z, name, main_star
 			FROM systems
-			WHERE id64 IN ({placeholders})
-		''', tuple(unique_ids))
+			WHERE id64 IN (SELECT value FROM json_each(?))
+		''', id64_list)
 		
 		systems_map = {
-			row[0]: SystemData(
-				id64=row[0],
-				x=row[1],
-				y=row[2],
-				z=row[3],
-				name=row[4],
-				mainStar=row[5]
-			)
-			for row in cursor.fetchall()
+			row[0]: SystemData._make(row)
+			for row in rows
 		}
 		
 		return [systems_map.get(id64) for id64 in id64_list]
@@ -373,33 +561,89 @@ class GalaxyDatabase:
 		if not id64_list:
 			return []
 		
-		unique_ids = set(id64_list)
-		placeholders = ','.join('?' * len(unique_ids))
-		cursor = self.conn.cursor()
-		cursor.execute(f'''
+		rows = self._select_by_id64s('''
 			SELECT id64, population, security, controllingFaction, 
 				primaryEconomy, secondaryEconomy
 			FROM population_data
-			WHERE id64 IN ({placeholders})
-		''', tuple(unique_ids))
+			WHERE id64 IN (SELECT value FROM json_each(?))
+		''', id64_list)
 		
 		populations_map = {
-			row[0]: PopulationData(
-				id64=row[0],
-				population=row[1],
-				security=row[2],
-				controllingFaction=row[3],
-				primaryEconomy=row[4],
-				secondaryEconomy=row[5]
-			)
-			for row in cursor.fetchall()
+			row[0]: PopulationData._make(row)
+			for row in rows
 		}
 		
 		return [populations_map.get(id64) for id64 in id64_list]
 
+	def query_closest_unowned(self, id64_iterable, radius, workers=None):
+		"""
+		Find unowned systems (no population data or no controlling faction) within
+		radius of any of the given systems, each with the closest of those systems.
+		Equally distant systems are resolved in id64_iterable order.
+		Returns (unowned_id64, closest_system_id64, distance²) rows.
+		
+		The systems are split between workers threads (default: one per CPU), each
+		querying through its own read-only connection.
+		"""
+		id64_list = list(id64_iterable)
+		workers = min(workers or os.cpu_count() or 1, len(id64_list))
+		if workers < 2 or not self._can_share():
+			return self._query_closest_unowned(self.ro_conn, id64_list, radius)
+		
+		def query_chunk(chunk):
+			conn = self._open_read_only()
+			try:
+				return self._query_closest_unowned(conn, chunk, radius)
+			finally:
+				conn.close()
+		
+		chunk_size = -(-len(id64_list) // workers)
+		chunks = [id64_list[i:i + chunk_size] for i in range(0, len(id64_list), chunk_size)]
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(query_chunk, chunks))
+		
+		# Chunks are in id64_list order, earlier chunk keeps equally distant candidates
+		closest: Dict[int, Tuple[int, float]] = {}  # id64 -> (closest_system_id64, distance²)
+		for rows in results:
+			for candidate_id, faction_id, dist_sq in rows:
+				current = closest.get(candidate_id)
+				if current is None or dist_sq < current[1]:
+					closest[candidate_id] = (faction_id, dist_sq)
+		return [(candidate_id, faction_id, dist_sq)
+				for candidate_id, (faction_id, dist_sq) in closest.items()]
+
+	def _query_closest_unowned(self, conn, id64_list, radius):
+		"""query_closest_unowned() for one list of systems, through conn"""
+		cursor = conn.cursor()
+		cursor.execute('''
+			WITH pairs AS (
+				SELECT s.id64 AS candidate_id, f.id64 AS faction_id, j.key AS faction_order,
+					(s.x - f.x) * (s.x - f.x) + (s.y - f.y) * (s.y - f.y) + (s.z - f.z) * (s.z - f.z) AS dist_sq
+				FROM json_each(?) j
+				JOIN systems f ON f.id64 = j.value
+				JOIN systems_rtree r
+					ON r.maxX >= f.x - ? AND r.minX <= f.x + ?
+					AND r.maxY >= f.y - ? AND r.minY <= f.y + ?
+					AND r.maxZ >= f.z - ? AND r.minZ <= f.z + ?
+				JOIN systems s ON s.id64 = r.id64
+				LEFT JOIN population_data p ON p.id64 = s.id64
+				WHERE dist_sq <= ?
+					AND s.id64 != f.id64
+					AND (p.id64 IS NULL OR p.controllingFaction = '')
+			)
+			SELECT candidate_id, faction_id, dist_sq
+			FROM (
+				SELECT candidate_id, faction_id, dist_sq,
+					ROW_NUMBER() OVER (PARTITION BY candidate_id ORDER BY dist_sq, faction_order) AS rn
+				FROM pairs
+			)
+			WHERE rn = 1
+		''', (json.dumps(list(id64_list)),) + (radius,) * 6 + (radius * radius,))
+		return cursor.fetchall()
+
 	def get_factions(self, pattern=None):
 		"""Get list of factions with system counts, optionally filtered by pattern"""
-		cursor = self.conn.cursor()
+		cursor = self.ro_conn.cursor()
 		if pattern:
 			cursor.execute('''
 			SELECT controllingFaction, COUNT(*) as count
@@ -420,7 +664,7 @@ class GalaxyDatabase:
 
 	def query_systems_by_faction(self, faction_name):
 		"""Query systems controlled by a specific faction"""
-		cursor = self.conn.cursor()
+		cursor = self.ro_conn.cursor()
 
 		any_faction = is_any_faction(faction_name)
 		where_clause = "p.controllingFaction != ''" if any_faction else "p.controllingFaction = ?"
@@ -436,56 +680,66 @@ class GalaxyDatabase:
 		WHERE {where_clause}
 		''', params)
 		
-		results = []
-		for row in cursor.fetchall():
-			system = SystemData(
-				id64=row[0],
-				x=row[1],
-				y=row[2],
-				z=row[3],
-				name=row[4],
-				mainStar=row[5]
-			)
-			population = PopulationData(
-				id64=row[0],
-				population=row[6],
-				security=row[7],
-				controllingFaction=row[8],
-				primaryEconomy=row[9],
-				secondaryEconomy=row[10]
-			)
-			results.append((system, population))
-		return results
+		return [
+			(SystemData._make(row[:6]), PopulationData(row[0], *row[6:]))
+			for row in cursor.fetchall()
+		]
+
+	def _begin_load_transaction(self, cursor):
+		"""
+		Start the single transaction of a bulk load, so the write lock is taken only once.
+		Nothing is committed before the load finishes.
+		"""
+		cursor.execute("BEGIN IMMEDIATE")
+
+	def _commit_load_transaction(self, cursor):
+		"""Commit the bulk load"""
+		self.conn.commit()
+
+	def _insert_batch(self, cursor, sql, rows, tracker, item_type):
+		"""
+		Insert buffered rows in one executemany() call. The batch runs in its own savepoint:
+		if it fails, it is rolled back and retried row by row, skipping the failing records.
+		"""
+		cursor.execute("SAVEPOINT load_batch")
+		try:
+			cursor.executemany(sql, rows)
+		except sqlite3.Error:
+			cursor.execute("ROLLBACK TO load_batch")
+			for row in rows:
+				try:
+					cursor.execute(sql, row)
+				except sqlite3.Error as e:
+					print(f"Error processing record {row[0]}: {e}", file=sys.stderr)
+		cursor.execute("RELEASE load_batch")
+		if tracker.should_report(len(rows)):
+			tracker.print_stats(item_type)
+		rows.clear()
 
 	def update_systems(self, systems_gz):
 		"""Update systems table from gzipped JSON file"""
 		cursor = self.conn.cursor()
-		tracker = AdaptiveUpdateTracker(batch_size=50_000, time_interval=5.0, max_time_check_batch=50_000)
-		cursor.execute("BEGIN TRANSACTION")
+		tracker = ProgressTracker()
+		indexes_dropped = self._begin_bulk_load('systems')
+		buf = []
+		self._begin_load_transaction(cursor)
 		
-		with gzip.open(systems_gz, 'rb') as f:
+		with open_gz_dump(systems_gz) as f:
 			for obj in ijson.items(f, 'item', use_float=True):
 				name = obj['name']
 				mainStar = obj.get('mainStar', "N/A")
 				c = obj['coords']
 				x, y, z = c['x'], c['y'], c['z']
 				id64 = obj['id64']
-				grid_x, grid_y, grid_z = gkey(x, y, z)
-				
-				cursor.execute('''
-				INSERT OR REPLACE INTO systems 
-				(id64, grid_x, grid_y, grid_z, x, y, z, name, main_star)
-				VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-				''', (id64, grid_x, grid_y, grid_z, x, y, z, name, mainStar))
 				
-				if tracker.should_commit():
-					self.conn.commit()
-					cursor.execute("BEGIN TRANSACTION")
-					tracker.print_stats('systems')
+				buf.append((id64, x, y, z, name, mainStar))
+				if len(buf) >= INSERT_BATCH_SIZE:
+					self._insert_batch(cursor, INSERT_SYSTEM_SQL, buf, tracker, 'systems')
 		
-		self.conn.commit()
-		cursor.execute("ANALYZE")
-		self.conn.commit()
+		if buf:
+			self._insert_batch(cursor, INSERT_SYSTEM_SQL, buf, tracker, 'systems')
+		self._commit_load_transaction(cursor)
+		self._end_bulk_load('systems', indexes_dropped)
 		tracker.print_stats('systems', final=True)
 
 	def _restore_from_file(self, src_path: str):
@@ -527,10 +781,12 @@ class GalaxyDatabase:
 	def update_population_data(self, pop_gz):
 		"""Update population data table from gzipped JSON file"""
 		cursor = self.conn.cursor()
-		tracker = AdaptiveUpdateTracker(batch_size=50_000, time_interval=5.0)
-		cursor.execute("BEGIN TRANSACTION")
+		tracker = ProgressTracker()
+		indexes_dropped = self._begin_bulk_load('population_data')
+		buf = []
+		self._begin_load_transaction(cursor)
 		
-		with gzip.open(pop_gz, 'rb') as f:
+		with open_gz_dump(pop_gz) as f:
 			for obj in ijson.items(f, 'item', use_float=True):
 				try:
 					id64 = obj['id64']
@@ -546,29 +802,26 @@ class GalaxyDatabase:
 					if 'controllingFaction' in obj and isinstance(obj['controllingFaction'], dict):
 						controlling_faction = obj['controllingFaction'].get('name', '')
 					
-					cursor.execute('''
-					INSERT OR REPLACE INTO population_data 
-					(id64, population, security, controllingFaction, 
-					 primaryEconomy, secondaryEconomy)
-					VALUES (?, ?, ?, ?, ?, ?)
-					''', (id64, population, security, controlling_faction,
-						  primary_economy, secondary_economy))
-					
-					if tracker.should_commit():
-						self.conn.commit()
-						cursor.execute("BEGIN TRANSACTION")
-						tracker.print_stats('population records')
+					buf.append((id64, population, security, controlling_faction,
+								primary_economy, secondary_economy))
 				except Exception as e:
 					print(f"Error processing record: {e}", file=sys.stderr)
 					continue
+				
+				if len(buf) >= INSERT_BATCH_SIZE:
+					self._insert_batch(cursor, INSERT_POPULATION_SQL, buf, tracker, 'population records')
 		
-		self.conn.commit()
-		cursor.execute("ANALYZE")
-		self.conn.commit()
+		if buf:
+			self._insert_batch(cursor, INSERT_POPULATION_SQL, buf, tracker, 'population records')
+		self._commit_load_transaction(cursor)
+		self._end_bulk_load('population_data', indexes_dropped)
 		tracker.print_stats('population records', final=True)
 		
 	def close(self):
-		"""Safely close database connection"""
+		"""Safely close database connections"""
+		if self.ro_conn is not None and self.ro_conn is not self.conn:
+			self.ro_conn.close()
+		self.ro_conn = None
 		if self.conn:
 			self.conn.close()
 			self.conn = None
@@ -587,33 +840,26 @@ class GalaxyDatabase:
 
 def query_systems_by_radius(db, center_x, center_y, center_z, radius):
 	"""Find systems within a given radius from coordinates"""
-	# Calculate grid cell range to search
-	min_gx = int(floor((center_x - radius) / GRID))
-	max_gx = int(floor((center_x + radius) / GRID))
-	min_gy = int(floor((center_y - radius) / GRID))
-	max_gy = int(floor((center_y + radius) / GRID))
-	min_gz = int(floor((center_z - radius) / GRID))
-	max_gz = int(floor((center_z + radius) / GRID))
-	
-	# Get candidate systems from relevant grid cells
-	candidate_systems = db.query_grid_cell_range(
-		min_gx, max_gx, min_gy, max_gy, min_gz, max_gz
+	# Get candidate systems from the bounding box of the sphere
+	rows = db.query_box_rows(
+		center_x - radius, center_x + radius,
+		center_y - radius, center_y + radius,
+		center_z - radius, center_z + radius
 	)
 	
-	# Filter by actual distance
-	results = []
-	radius_sq = radius * radius
-	for system in candidate_systems:
-		dx = system.x - center_x
-		dy = system.y - center_y
-		dz = system.z - center_z
-		dist_sq = dx*dx + dy*dy + dz*dz
-		
-		if dist_sq <= radius_sq:
-			population = db.get_population_by_id64(system.id64)
-			results.append((system, population, sqrt(dist_sq)))  # Return actual distance
+	if not rows:
+		return []
+	
+	# Filter by actual distance, only systems inside become SystemData
+	coords = np.array([row[1:4] for row in rows])
+	dist_sq = ((coords - (center_x, center_y, center_z)) ** 2).sum(axis=1)
+	inside = np.flatnonzero(dist_sq <= radius * radius)
+	systems = [SystemData._make(rows[i]) for i in inside]
 	
-	return results
+	# One query for population of all systems inside
+	populations = db.get_populations_by_id64s(s.id64 for s in systems)
+	distances = np.sqrt(dist_sq[inside]).tolist()  # Return actual distance
+	return list(zip(systems, populations, distances))
 
 def print_system_with_population(system, population):
 	"""Print system and population data in readable format"""
@@ -681,43 +927,14 @@ def find_colony_candidates(db, args):
 	# Create mapping for quick faction system lookup
 	faction_system_map = {sys.id64: sys for sys, pop in faction_systems}
 	
-	# Track closest faction system for each candidate
-	candidate_info: Dict[int, Tuple[float, int]] = {}  # id64 -> (distance, faction_sys_id)
-	
-	# Find candidate systems
+	# Find candidate systems and their closest faction system in one query
 	start_time = time.time()
-	last_update = start_time
-	update_interval = 10  # seconds
-	
 	total_faction_systems = len(faction_systems)
-	for i, (faction_sys, faction_pop) in enumerate(faction_systems, 1):
-		# Query systems around this faction system
-		candidates = query_systems_by_radius(
-			db, faction_sys.x, faction_sys.y, faction_sys.z, candidate_range
-		)
-		
-		for candidate_sys, candidate_pop, dist_to_faction in candidates:
-			# Skip if this is the faction system itself
-			if candidate_sys.id64 == faction_sys.id64:
-				continue
-			
-			# Check if candidate is unowned (no population data or empty controlling faction)
-			if candidate_pop is None or candidate_pop.controllingFaction == '':
-				# Update candidate info if this is the closest faction system found so far
-				current = candidate_info.get(candidate_sys.id64)
-				if current is None or dist_to_faction < current[0]:
-					candidate_info[candidate_sys.id64] = (dist_to_faction, faction_sys.id64)
-		
-		# Progress update
-		current_time = time.time()
-		if current_time - last_update > update_interval:
-			elapsed = current_time - start_time
-			candidates_found = len(candidate_info)
-			print(f"Processed {i}/{total_faction_systems} faction systems "
-				  f"({i/total_faction_systems:.1%}) - "
-				  f"Found {candidates_found} candidate systems - "
-				  f"Time elapsed: {elapsed:.1f}s")
-			last_update = current_time
+	candidate_info: Dict[int, Tuple[float, int]] = {  # id64 -> (distance, faction_sys_id)
+		candidate_id: (sqrt(dist_sq), faction_id)
+		for candidate_id, faction_id, dist_sq
+		in db.query_closest_unowned(faction_system_map, candidate_range)
+	}
 	
 	total_time = time.time() - start_time
 	print(f"\nProcessed all {total_faction_systems} faction systems in {total_time:.1f} seconds")
@@ -783,6 +1000,9 @@ def build_parser():
 	parser.add_argument('--rebuild-index', help='Rebuild index after database operations', action='store_true')
 	parser.add_argument('--dump-to', default=None, help='Dump to file after all operations')
 	parser.add_argument('--restore-from', default=None, help='Restore from file before all operations')
+	parser.add_argument('--memory-load', action='store_true',
+						help='Run update in memory, then write database to --db file. '
+							 'Needs RAM for the whole database (tens of GB for full galaxy)')
 	
 	subparsers = parser.add_subparsers(dest='command', required=True,
 									  help='Command to execute')
@@ -828,7 +1048,19 @@ def build_parser():
 	return parser
 
 def process_commands(args):
-	with GalaxyDatabase(args.db, args.restore_from) as db:
+	db_path = args.db
+	restore_from = args.restore_from
+	if args.memory_load:
+		if args.command not in ('update-systems', 'update-pop'):
+			print("Error: --memory-load only works with update-systems and update-pop")
+			sys.exit(1)
+		# Dump replaces the --db file, so existing data must be loaded too
+		if restore_from is None and os.path.exists(args.db):
+			restore_from = args.db
+		db_path = ':memory:'
+
+	bulk_load = args.command in ('update-systems', 'update-pop')
+	with GalaxyDatabase(db_path, restore_from, bulk_load) as db:
 		if args.drop_index:
 			print(f"Dropping database indexes")
 			db.drop_indexes()
@@ -895,6 +1127,9 @@ def process_commands(args):
 			db.create_indexes()
 			print(f"Done rebuilding database indexes")
 
+		if args.memory_load:
+			db.dump_to_file(args.db)
+
 		if args.dump_to:
 			db.dump_to_file(args.dump_to)
 